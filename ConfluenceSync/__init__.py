@@ -29,21 +29,20 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         )
 
     try:
-        confluence_sync = ConfluenceSync(space=space)
-        
-        if ingestion_type == 'full':
-            confluence_sync.process_page_full(confluence_sync.root_page_id, path='')
-            return func.HttpResponse(f"Full sync completed for space: {space}.", status_code=200)
-        elif ingestion_type == 'incremental':
-            confluence_sync.process_page_incremental()
-            return func.HttpResponse(f"Incremental sync completed for space: {space}.", status_code=200)
-        else:
-            return func.HttpResponse(
-                "Invalid 'type' parameter. Please use 'full' or 'incremental'.",
-                status_code=400
-            )
+        with ConfluenceSync(space=space) as confluence_sync:
+            if ingestion_type == 'full':
+                confluence_sync.process_page_full(confluence_sync.root_page_id, path='')
+                return func.HttpResponse(f"Full sync completed for space: {space}.", status_code=200)
+            elif ingestion_type == 'incremental':
+                confluence_sync.process_page_incremental()
+                return func.HttpResponse(f"Incremental sync completed for space: {space}.", status_code=200)
+            else:
+                return func.HttpResponse(
+                    "Invalid 'type' parameter. Please use 'full' or 'incremental'.",
+                    status_code=400
+                )
     except Exception as e:
-        logging.error(f"An error occurred: {e}")
+        logging.exception(f"An error occurred: {e}")
         return func.HttpResponse(
             "An error occurred while processing the request.",
             status_code=500
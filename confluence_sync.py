@@ -1,42 +1,127 @@
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
-from azure.storage.blob import BlobServiceClient
+from urllib3.util.retry import Retry
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+from azure.core.pipeline.transport import RequestsTransport
+from azure.storage.blob import BlobServiceClient, ContentSettings
+import gzip
+import logging
+import orjson
 import os
 from dotenv import load_dotenv
 from atlassian import Confluence
-from datetime import datetime, timedelta
-from typing import List, Tuple, Dict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, time, timedelta, timezone
+from typing import Callable, List, Tuple, Dict, Optional, Set
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# Shared across invocations of a warm Azure Functions worker
+_BLOB_SERVICE_CLIENTS: Dict[str, BlobServiceClient] = {}
+_CONTAINERS_ENSURED: Set[str] = set()
+
 class ConfluenceSync:
+    # Number of pages processed concurrently, also used to size the HTTP connection pool
+    MAX_WORKERS = 20
+    # Margin applied to the stored sync time, since CQL reads dates in the Confluence user's time zone
+    STATE_OVERLAP = timedelta(hours=14)
+    # Replaces path separators in titles and drops control characters, which break blob names
+    _BLOB_SAFE_TABLE = str.maketrans({'/': '_', '\\': '_', **{chr(code): None for code in range(32)}})
+
     def __init__(self, space: str):
         self.space = space
         self.base_url = os.getenv('CONFLUENCE_BASE_URL')
         self.confluence_base_url = os.getenv("CONFLUENCE_REST_API_URL")
         self.username = os.getenv("ATLASSIAN_USERNAME")
         self.token = os.getenv("ATLASSIAN_TOKEN")
-        self.confluence = Confluence(url=self.base_url, username=self.username, password=self.token)
         self.azure_connection_string = os.getenv("STORAGE_CONNECTION_STRING")
         self.auth = HTTPBasicAuth(self.username, self.token)
+        self.session = self._create_session()
+        # Share the pooled session with the atlassian client instead of letting it open its own
+        self.confluence = Confluence(url=self.base_url, username=self.username, password=self.token, session=self.session)
         self.container_name = 'public' if self.space == 'SIA' else 'private'
-        self.blob_service_client = BlobServiceClient.from_connection_string(self.azure_connection_string)
+        if self.azure_connection_string not in _BLOB_SERVICE_CLIENTS:
+            _BLOB_SERVICE_CLIENTS[self.azure_connection_string] = BlobServiceClient.from_connection_string(
+                self.azure_connection_string,
+                transport=self._create_blob_transport()
+            )
+        self.blob_service_client = _BLOB_SERVICE_CLIENTS[self.azure_connection_string]
         self.container_client = self.blob_service_client.get_container_client(self.container_name)
+        self._blob_versions: Dict[str, str] = {}
         self._create_container()
         self.root_page_id = self.get_root_page_id()
 
+    def _create_session(self) -> requests.Session:
+        """
+        Creates a shared HTTP session so Confluence requests reuse pooled connections.
+
+        Returns:
+            requests.Session: The configured session.
+        """
+        session = requests.Session()
+        session.auth = self.auth
+        # Back off on rate limiting and transient errors, honoring the Retry-After header Confluence sends with 429s
+        retries = Retry(
+            total=5,
+            backoff_factor=1.0,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=['GET', 'HEAD'],
+            respect_retry_after_header=True
+        )
+        adapter = HTTPAdapter(pool_connections=self.MAX_WORKERS, pool_maxsize=self.MAX_WORKERS, max_retries=retries)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def _create_blob_transport(self) -> RequestsTransport:
+        """
+        Creates the Azure SDK transport with a connection pool large enough for all the workers.
+
+        The SDK default pool keeps 10 connections, which would make concurrent uploads wait on each other.
+
+        Returns:
+            RequestsTransport: The configured transport.
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.MAX_WORKERS, pool_maxsize=self.MAX_WORKERS)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return RequestsTransport(session=session)
+
+    def close(self) -> None:
+        """
+        Closes the shared HTTP session.
+        """
+        self.session.close()
+
+    def __enter__(self) -> 'ConfluenceSync':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
     def _create_container(self) -> None:
         """
         Creates the Azure Blob Storage container if it doesn't exist.
+
+        The check runs once per container and worker process.
         """
+        if self.container_name in _CONTAINERS_ENSURED:
+            return
         try:
             self.container_client.create_container()
-        except Exception as e:
-            print(f"Container already exists or could not be created: {e}")
+            _CONTAINERS_ENSURED.add(self.container_name)
+        except ResourceExistsError:
+            _CONTAINERS_ENSURED.add(self.container_name)
+        except Exception:
+            logger.exception("Container %s could not be created", self.container_name)
 
     def upload_to_azure_blob(self, content: str, blob_name: str, metadata: Dict[str, str]) -> None:
         """
-        Uploads content to Azure Blob Storage.
+        Uploads gzip-compressed content to Azure Blob Storage.
 
         Args:
             content (str): The content to upload.
@@ -46,13 +131,64 @@ class ConfluenceSync:
         Returns:
             None
         """
-        try:
-            blob_client = self.container_client.get_blob_client(blob_name)
-            blob_client.upload_blob(content, overwrite=True)
-            blob_client.set_blob_metadata(metadata)
-            print(f"Uploaded {blob_name} to Azure Blob Storage.")
-        except Exception as e:
-            print(f"Failed to upload {blob_name}: {e}")
+        blob_client = self.container_client.get_blob_client(blob_name)
+        # HTML compresses well, so store it gzipped and let HTTP clients decompress it
+        payload = gzip.compress(content.encode('utf-8'), compresslevel=6)
+        # Metadata is sent with the upload to avoid a separate set_blob_metadata call
+        blob_client.upload_blob(
+            payload,
+            overwrite=True,
+            metadata=metadata,
+            max_concurrency=4,
+            content_settings=ContentSettings(content_type='text/html; charset=utf-8', content_encoding='gzip')
+        )
+        logger.info("Uploaded %s to Azure Blob Storage.", blob_name)
+
+    def is_blob_up_to_date(self, blob_name: str, version: int) -> bool:
+        """
+        Checks whether a blob already holds the given version of a page.
+
+        Args:
+            blob_name (str): The name of the blob.
+            version (int): The Confluence version number of the page.
+
+        Returns:
+            bool: True if the stored blob has the same version, False otherwise.
+        """
+        return self._blob_versions.get(blob_name) == str(version)
+
+    def load_blob_versions(self) -> None:
+        """
+        Loads the stored page version of every blob in the container with a single listing.
+
+        Returns:
+            None
+        """
+        blobs = self.container_client.list_blobs(include=['metadata'])
+        self._blob_versions = {blob.name: (blob.metadata or {}).get('version') for blob in blobs}
+
+    def _get_all_results(self, url: str, params: Dict) -> List[Dict]:
+        """
+        Retrieves every result of a paginated Confluence endpoint by following its next links.
+
+        Args:
+            url (str): The URL of the first page of results.
+            params (Dict): The query parameters of the first request.
+
+        Returns:
+            List[Dict]: The results of all pages.
+        """
+        results = []
+        while url:
+            response = self.session.get(url, params=params)
+            response.raise_for_status()  # Raise an exception for HTTP errors
+            data = orjson.loads(response.content)
+            results.extend(data['results'])
+            links = data.get('_links', {})
+            # The next link already carries the query string
+            url = f"{links['base']}{links['next']}" if 'next' in links else None
+            params = None
+        return results
 
     def get_child_pages(self, parent_id: str) -> List[Dict]:
         """
@@ -62,14 +198,13 @@ class ConfluenceSync:
             parent_id (str): The ID of the parent page.
 
         Returns:
-            List[Dict]: A list of child pages.
+            List[Dict]: A list of child pages, including their version.
         """
         url = f"{self.confluence_base_url}/{parent_id}/child/page"
-        response = requests.get(url, auth=self.auth)
-        response.raise_for_status()  # Raise an exception for HTTP errors
-        return response.json()['results']
+        params = {'limit': 200, 'expand': 'version'}
+        return self._get_all_results(url, params)
 
-    def get_page_content(self, page_id: str) -> Tuple[str, str, str]:
+    def get_page_content(self, page_id: str) -> Tuple[str, str, str, str, int]:
         """
         Retrieves the content of a given page.
 
@@ -77,19 +212,31 @@ class ConfluenceSync:
             page_id (str): The ID of the page.
 
         Returns:
-            Tuple[str, str, str]: The title, body content, and created date of the page.
+            Tuple[str, str, str, str, int]: The title, body content, created date, URL and version number of the page.
         """
         url = f"{self.confluence_base_url}/{page_id}"
         params = {'expand': 'body.storage,version', 'orderby': 'history.lastModified desc', 'limit': 1}
-        response = requests.get(url, auth=self.auth, params=params)
+        response = self.session.get(url, params=params)
         response.raise_for_status()  # Raise an exception for HTTP errors
-        data = response.json()
+        return self._parse_page(orjson.loads(response.content))
+
+    def _parse_page(self, data: Dict) -> Tuple[str, str, str, str, int]:
+        """
+        Extracts the fields used by the sync from a page expanded with body.storage and version.
+
+        Args:
+            data (Dict): The page returned by the Confluence API.
+
+        Returns:
+            Tuple[str, str, str, str, int]: The title, body content, created date, URL and version number of the page.
+        """
         title = data['title']
         body_content = data['body']['storage']['value']
         created_date = data['version']['when']
-        page_url = f"https://sapiensia.atlassian.net/wiki/spaces/{self.space}/pages/{page_id}"
+        version = data['version']['number']
+        page_url = f"https://sapiensia.atlassian.net/wiki/spaces/{self.space}/pages/{data['id']}"
 
-        return title, body_content, created_date, page_url
+        return title, body_content, created_date, page_url, version
 
     def get_updated_page_content(self, page_id: str) -> Tuple[str, str, str]:
         """
@@ -101,14 +248,7 @@ class ConfluenceSync:
         Returns:
             Tuple[str, str, str]: The title, body content, and created date of the page.
         """
-        url = f"{self.confluence_base_url}/{page_id}"
-        params = {'expand': 'body.storage,version', 'orderby': 'history.lastModified desc', 'limit': 1}
-        response = requests.get(url, auth=self.auth, params=params)
-        response.raise_for_status()  # Raise an exception for HTTP errors
-        data = response.json()
-        title = data['title']
-        body_content = data['body']['storage']['value']
-        created_date = data['version']['when']
+        title, body_content, created_date, _, _ = self.get_page_content(page_id)
         return title, body_content, created_date
 
     def get_root_page_id(self) -> str:
@@ -125,9 +265,28 @@ class ConfluenceSync:
         root_page_id = ancestors[0]['id']
         return root_page_id
 
+    def search_pages(self, cql: str, expand: str, limit: int = 100) -> List[Dict]:
+        """
+        Runs a CQL search, following the pagination links until all results are fetched.
+
+        Args:
+            cql (str): The CQL query.
+            expand (str): The properties to expand on each result.
+            limit (int): The page size requested per call.
+
+        Returns:
+            List[Dict]: The content items matching the query.
+        """
+        url = f"{self.confluence_base_url}/search"
+        params = {'cql': cql, 'expand': expand, 'limit': limit}
+        return self._get_all_results(url, params)
+
     def process_page_full(self, page_id: str, path: str = '') -> None:
         """
-        Processes a page and its child pages recursively, uploading their content to Azure Blob Storage.
+        Processes a page and all of its descendants, uploading their content to Azure Blob Storage.
+
+        The pages are fetched in bulk through a CQL search, and each page path is rebuilt
+        from its ancestors instead of walking the tree one request at a time.
 
         Args:
             page_id (str): The ID of the page.
@@ -136,60 +295,168 @@ class ConfluenceSync:
         Returns:
             None
         """
-        try:
-            # Get page content
-            title, content, created_date, page_url = self.get_page_content(page_id)
-            # Define blob name based on path and title
-            blob_name = os.path.join(path, f"{title}.html").replace("\\", "/")
-            metadata = {'created_date': created_date, "page_url" : page_url}
-            # Upload content to Azure Blob Storage
-            self.upload_to_azure_blob(content, blob_name, metadata)
-            # Get child pages and process them recursively
-            child_pages = self.get_child_pages(page_id)
-            for child in child_pages:
-                self.process_page_full(child['id'], os.path.join(path, title))
-        except Exception as e:
-            print(f"An error occurred: {e}")
-
-    def build_full_path(self, page_id: str) -> str:
+        self.load_blob_versions()
+        cql = f'space = "{self.space}" AND type = page AND (id = {page_id} OR ancestor = {page_id})'
+        # Bodies are fetched later, only for pages whose version changed
+        pages = self.search_pages(cql, expand='version,ancestors')
+        self._process_pages(lambda page: self._process_one_full(page, page_id, path), pages)
+
+    def _process_pages(self, process: Callable[[Dict], None], pages: List[Dict]) -> None:
+        """
+        Runs a processing function on every page with the worker pool, logging each page that fails.
+
+        Args:
+            process (Callable[[Dict], None]): The function applied to each page.
+            pages (List[Dict]): The pages returned by the CQL search.
+
+        Raises:
+            RuntimeError: If any page failed, once every page has been handled.
+
+        Returns:
+            None
+        """
+        errors = []
+        with ThreadPoolExecutor(max_workers=self.MAX_WORKERS) as executor:
+            futures = {executor.submit(process, page): page['id'] for page in pages}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.exception("Failed to sync page %s", futures[future])
+                    errors.append(e)
+        if errors:
+            raise RuntimeError(f"{len(errors)} of {len(pages)} pages failed to sync") from errors[0]
+
+    def _process_one_full(self, page: Dict, root_page_id: str, path: str) -> None:
+        """
+        Uploads a single page returned by the full sync search.
+
+        Args:
+            page (Dict): The page returned by the CQL search.
+            root_page_id (str): The ID of the page the sync started from.
+            path (str): The path to the starting page.
+
+        Returns:
+            None
+        """
+        title = page['title']
+        # Keep only the ancestors below the starting page
+        ancestor_ids = [ancestor['id'] for ancestor in page['ancestors']]
+        if page['id'] == root_page_id or root_page_id not in ancestor_ids:
+            ancestors = []
+        else:
+            ancestors = page['ancestors'][ancestor_ids.index(root_page_id):]
+        # Define blob name based on path and title
+        full_path = '/'.join(filter(None, [path, self.build_full_path(page['id'], ancestors)]))
+        blob_name = self.build_blob_name(full_path, title)
+        # Skip the body fetch and upload when the stored blob is already current
+        if self.is_blob_up_to_date(blob_name, page['version']['number']):
+            return
+        _, content, created_date, page_url, version = self.get_page_content(page['id'])
+        metadata = {'created_date': created_date, "page_url" : page_url, 'version': str(version)}
+        # Upload content to Azure Blob Storage
+        self.upload_to_azure_blob(content, blob_name, metadata)
+
+    def build_full_path(self, page_id: str, ancestors: List[Dict]) -> str:
         """
         Builds the full path of a page based on its ancestors.
 
         Args:
             page_id (str): The ID of the page.
+            ancestors (List[Dict]): The ancestors of the page, as returned with expand=ancestors.
 
         Returns:
             str: The full path of the page.
         """
-        ancestors = self.confluence.get_page_ancestors(page_id)
-        ancestor_titles = [ancestor['title'] for ancestor in ancestors]
-        return '/'.join(ancestor_titles)
+        ancestor_titles = [ancestor['title'].translate(self._BLOB_SAFE_TABLE) for ancestor in ancestors]
+        return '/'.join(filter(None, ancestor_titles))
+
+    def build_blob_name(self, path: str, title: str) -> str:
+        """
+        Builds the blob name of a page from its path and title.
+
+        Args:
+            path (str): The path to the page, with "/" separators.
+            title (str): The title of the page.
+
+        Returns:
+            str: The blob name of the page.
+        """
+        file_name = f"{title.translate(self._BLOB_SAFE_TABLE)}.html"
+        return f"{path}/{file_name}" if path else file_name
+
+    def get_last_sync(self) -> Optional[datetime]:
+        """
+        Reads the time of the last successful incremental sync of the space.
+
+        Returns:
+            Optional[datetime]: The UTC time the last sync started, or None if the space was never synced.
+        """
+        blob_client = self.container_client.get_blob_client(f"_state/{self.space}.json")
+        try:
+            state = orjson.loads(blob_client.download_blob().readall())
+        except ResourceNotFoundError:
+            return None
+        return datetime.fromisoformat(state['last_sync_utc'])
+
+    def save_last_sync(self, last_sync: datetime) -> None:
+        """
+        Stores the time of the last successful incremental sync of the space.
+
+        Args:
+            last_sync (datetime): The UTC time the sync started.
+
+        Returns:
+            None
+        """
+        blob_client = self.container_client.get_blob_client(f"_state/{self.space}.json")
+        blob_client.upload_blob(
+            orjson.dumps({'last_sync_utc': last_sync.isoformat()}),
+            overwrite=True,
+            content_settings=ContentSettings(content_type='application/json')
+        )
 
     def process_page_incremental(self) -> None:
         """
-        Processes pages incrementally, uploading their content to Azure Blob Storage.
+        Processes the pages modified since the last successful incremental sync, uploading their content to Azure Blob Storage.
 
         Returns:
             None
         """
-        try:
-            # Calculate yesterday's date
-            yesterday = (datetime.now() - timedelta(1)).strftime('%Y-%m-%d')
-            # CQL query to find pages modified yesterday
-            cql = f"space = {self.space} AND type = page AND lastmodified >= {yesterday} AND lastmodified < {datetime.now().strftime('%Y-%m-%d')}"
-            # Execute the query and extract page IDs
-            results = self.confluence.cql(cql, expand="ancestors")
-            page_ids = [result['content']['id'] for result in results['results']]
-            for page_id in page_ids:
-                # Get content and path
-                title, body_content, created_date, page_url = self.get_page_content(page_id)
-                # Build full path
-                path = self.build_full_path(page_id)
-                # Define blob name based on path and title
-                blob_name = os.path.join(path, f"{title}.html").replace("\\", "/")
-                metadata = {'created_date': created_date, "page_url" : page_url}
-                # Save HTML to full path
-                self.upload_to_azure_blob(body_content, blob_name, metadata)
-        except Exception as e:
-            print(f"An error occurred: {e}")
+        self.load_blob_versions()
+        sync_started = datetime.now(timezone.utc)
+        last_sync = self.get_last_sync()
+        if last_sync is None:
+            # First run for the space: start from yesterday's pages
+            since = datetime.combine(sync_started.date() - timedelta(days=1), time.min, tzinfo=timezone.utc)
+        else:
+            since = last_sync - self.STATE_OVERLAP
+        # CQL query to find pages modified since the last sync
+        cql = f'space = "{self.space}" AND type = page AND lastmodified >= "{since:%Y-%m-%d %H:%M}"'
+        # Bodies are fetched later, only for pages whose version changed
+        pages = self.search_pages(cql, expand='version,ancestors')
+        self._process_pages(self._process_one_incremental, pages)
+        # Only reached when every page was synced
+        self.save_last_sync(sync_started)
 
+    def _process_one_incremental(self, page: Dict) -> None:
+        """
+        Uploads a single updated page to Azure Blob Storage.
+
+        Args:
+            page (Dict): The page returned by the CQL search.
+
+        Returns:
+            None
+        """
+        # Build full path
+        path = self.build_full_path(page['id'], page['ancestors'])
+        # Define blob name based on path and title
+        blob_name = self.build_blob_name(path, page['title'])
+        # Skip the body fetch and upload when the stored blob is already current
+        if self.is_blob_up_to_date(blob_name, page['version']['number']):
+            return
+        _, body_content, created_date, page_url, version = self.get_page_content(page['id'])
+        metadata = {'created_date': created_date, "page_url" : page_url, 'version': str(version)}
+        # Save HTML to full path
+        self.upload_to_azure_blob(body_content, blob_name, metadata)